@@ -1,12 +1,24 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import sqlite3
-import qrcode
 from io import BytesIO
-import matplotlib.pyplot as plt
 from datetime import datetime
 import json
+import logging
 import os
+import threading
+import queue
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
 
 # -----------------------
 # Config & DB connection
@@ -15,11 +27,55 @@ st.set_page_config(page_title="📊 Mentimeter Clone", layout="wide")
 DB_PATH = "votes.db"
 BASE_URL = "https://YOUR_DEPLOYED_STREAMLIT_APP_URL"  # Replace with your app link
 
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-c = conn.cursor()
+# WAL needs a local filesystem (shared memory); set MENTI_SQLITE_WAL=0 when
+# votes.db lives on a network share. WAL keeps votes.db-wal / votes.db-shm
+# files next to the database.
+USE_WAL = os.environ.get("MENTI_SQLITE_WAL", "1") != "0"
+READER_POOL_SIZE = 4
+
+logger = logging.getLogger(__name__)
+
+# -----------------------
+# SQL statements (module constants keep the sqlite3 statement cache keys stable)
+# -----------------------
+SQL_GET_QUESTION = "SELECT id, question_text, created_at, meta FROM questions WHERE id=?"
+SQL_GET_OPTIONS = "SELECT id, option_text FROM options WHERE question_id=? ORDER BY id"
+SQL_GET_ALL_QUESTIONS = "SELECT id, question_text, created_at FROM questions ORDER BY created_at DESC"
+SQL_GET_RESULTS = """
+    WITH t AS (
+        SELECT o.id, o.option_text, COUNT(v.id) AS cnt
+        FROM options o
+        LEFT JOIN votes v ON v.option_id = o.id AND v.question_id=?
+        WHERE o.question_id=?
+        GROUP BY o.id, o.option_text
+    )
+    SELECT option_text, cnt, id AS option_id,
+           COALESCE(cnt * 100.0 / NULLIF((SELECT SUM(cnt) FROM t), 0), 0) AS pct
+    FROM t
+    ORDER BY option_id
+"""
+SQL_GET_ALL_RESULTS = """
+    SELECT q.id AS question_id, o.id AS option_id, o.option_text, COUNT(v.id) AS cnt
+    FROM questions q
+    JOIN options o ON o.question_id = q.id
+    LEFT JOIN votes v ON v.option_id = o.id AND v.question_id = q.id
+    GROUP BY q.id, o.id, o.option_text
+    ORDER BY q.id, o.id
+"""
+SQL_INSERT_QUESTION = "INSERT INTO questions (question_text, created_at, meta) VALUES (?, ?, ?)"
+SQL_INSERT_OPTION = "INSERT INTO options (question_id, option_text) VALUES (?, ?)"
+SQL_INSERT_VOTE = "INSERT INTO votes (question_id, option_id, created_at) VALUES (?, ?, ?)"
+
+def apply_pragmas(c, writer: bool = True):
+    if writer and USE_WAL:
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute("PRAGMA synchronous=NORMAL")
+    c.execute("PRAGMA temp_store=MEMORY")
+    c.execute("PRAGMA mmap_size=268435456")
+    c.execute("PRAGMA cache_size=-20000")
 
 # Drop old tables if schema mismatch (optional safety)
-def ensure_schema():
+def ensure_schema(c):
     # Check if 'id' exists in votes table
     c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='votes'")
     if c.fetchone():
@@ -54,73 +110,259 @@ def ensure_schema():
         FOREIGN KEY(option_id) REFERENCES options(id) ON DELETE CASCADE
     )
     """)
-    conn.commit()
+    # Indexes for the results / options lookups
+    c.execute("CREATE INDEX IF NOT EXISTS idx_votes_qid_oid ON votes(question_id, option_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_options_qid ON options(question_id)")
+    # Full ANALYZE until there are statistics to keep (an empty database leaves
+    # sqlite_stat1 empty); after that the cheaper PRAGMA optimize is enough
+    c.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'")
+    has_stats = c.fetchone() is not None
+    if has_stats:
+        c.execute("SELECT 1 FROM sqlite_stat1 LIMIT 1")
+        has_stats = c.fetchone() is not None
+    c.execute("PRAGMA optimize" if has_stats else "ANALYZE")
+
+class Database:
+    """One locked writer connection shared by all sessions, plus a fixed pool of
+    read-only connections so reads don't queue behind the writer."""
+
+    def __init__(self, path: str):
+        self.path = path
+        # Autocommit mode; write() opens the transaction explicitly
+        self.writer = sqlite3.connect(path, check_same_thread=False, isolation_level=None,
+                                      cached_statements=256)
+        self.lock = threading.Lock()
+        apply_pragmas(self.writer.cursor())
+        with self.write() as c:
+            ensure_schema(c)
+        # Readers open after the schema exists; Streamlit runs every rerun on a
+        # fresh thread, so they are pooled rather than kept per thread
+        self.readers = queue.Queue()
+        uri = Path(path).resolve().as_uri() + "?mode=ro"
+        for _ in range(READER_POOL_SIZE):
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None,
+                                   cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            apply_pragmas(conn.cursor(), writer=False)
+            self.readers.put(conn)
 
-ensure_schema()
+    @contextmanager
+    def read(self):
+        # Blocks while all readers are checked out
+        conn = self.readers.get()
+        try:
+            yield conn.cursor()
+        finally:
+            self.readers.put(conn)
+
+    @contextmanager
+    def write(self):
+        # Commits on success, rolls back on error
+        with self.lock:
+            c = self.writer.cursor()
+            c.execute("BEGIN")
+            try:
+                yield c
+                c.execute("COMMIT")
+            except BaseException:
+                # SQLite may already have rolled back on its own
+                if self.writer.in_transaction:
+                    c.execute("ROLLBACK")
+                raise
+
+# Schema setup and PRAGMAs run once per process and DB path
+@st.cache_resource
+def db(path: str = DB_PATH) -> Database:
+    return Database(path)
+
+db()
+
+class VoteWriter:
+    """Queues votes in memory and writes them in batches from a background
+    thread, so a vote costs one append instead of an INSERT + commit."""
+
+    def __init__(self, database: Database, interval: float = 0.2):
+        self.db = database
+        self.interval = interval
+        self.queue = deque()
+        self.lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def put(self, question_id: int, option_id: int):
+        with self.lock:
+            self.queue.append((question_id, option_id, datetime.utcnow().isoformat()))
+
+    @contextmanager
+    def write(self):
+        """db.write() that first saves the queued votes in the same transaction,
+        so nothing queued before it can land after the caller's statements."""
+        batch = []
+        try:
+            with self.db.write() as c:
+                with self.lock:
+                    batch = list(self.queue)
+                    self.queue.clear()
+                if batch:
+                    c.executemany(SQL_INSERT_VOTE, batch)
+                yield c
+        except BaseException:
+            # Keep the votes for the next round
+            with self.lock:
+                self.queue.extendleft(reversed(batch))
+            raise
+        for qid in {vote[0] for vote in batch}:
+            get_results.clear(qid)
+        if batch:
+            get_all_results.clear()
+
+    def flush(self) -> bool:
+        """Write the queued votes now; returns False if they are still queued.
+
+        Always takes the DB lock, so a batch the background thread is already
+        writing has been committed by the time this returns."""
+        try:
+            with self.write():
+                pass
+        except sqlite3.Error:
+            logger.exception("Could not write queued votes; will retry")
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if self.queue:
+                # Keep the thread alive whatever happens, or queued votes are stuck
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("Vote writer flush failed; will retry")
+
+@st.cache_resource
+def vote_writer() -> VoteWriter:
+    return VoteWriter(db())
 
 # -----------------------
 # Utility functions
 # -----------------------
-def generate_qr_code_bytes(url: str):
-    qr = qrcode.make(url)
+@st.cache_data(max_entries=256, show_spinner=False)
+def generate_qr_code_bytes(url: str) -> bytes:
+    import qrcode  # only needed by the Questions Manager
+    qr = qrcode.QRCode(box_size=6, border=2)
+    qr.add_data(url)
+    img = qr.make_image(fill_color="black", back_color="white")
     buf = BytesIO()
-    qr.save(buf, format="PNG")
-    buf.seek(0)
-    return buf
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+@st.cache_data(show_spinner=False)
+def load_excel(file_bytes: bytes):
+    return pd.read_excel(BytesIO(file_bytes), engine=EXCEL_ENGINE)
 
-def insert_question_with_options(question_text: str, options_list: list, meta: dict = None):
+def insert_question_with_options(c, question_text: str, options_list: list, meta: dict = None):
     created_at = datetime.utcnow().isoformat()
     meta_json = json.dumps(meta) if meta else None
-    c.execute("INSERT INTO questions (question_text, created_at, meta) VALUES (?, ?, ?)",
-              (question_text, created_at, meta_json))
+    c.execute(SQL_INSERT_QUESTION, (question_text, created_at, meta_json))
     qid = c.lastrowid
-    for opt in options_list:
-        c.execute("INSERT INTO options (question_id, option_text) VALUES (?, ?)", (qid, opt))
-    conn.commit()
+    c.executemany(SQL_INSERT_OPTION, [(qid, opt) for opt in options_list])
     return qid
 
+def insert_batch(questions: list):
+    # One transaction (and one commit) for the whole upload
+    with db().write() as c:
+        qids = [insert_question_with_options(c, qtext, options, meta)
+                for qtext, options, meta in questions]
+    invalidate_caches()
+    return qids
+
 def get_question(qid: int):
-    c.execute("SELECT id, question_text, created_at, meta FROM questions WHERE id=?", (qid,))
-    row = c.fetchone()
-    if not row:
-        return None
-    q = {
-        "id": row[0],
-        "question_text": row[1],
-        "created_at": row[2],
-        "meta": json.loads(row[3]) if row[3] else None
-    }
-    c.execute("SELECT id, option_text FROM options WHERE question_id=? ORDER BY id", (qid,))
-    q["options"] = [{"id": r[0], "text": r[1]} for r in c.fetchall()]
-    return q
+    with db().read() as c:
+        c.execute(SQL_GET_QUESTION, (qid,))
+        row = c.fetchone()
+        if not row:
+            return None
+        q = {
+            "id": row["id"],
+            "question_text": row["question_text"],
+            "created_at": row["created_at"],
+            "meta": json.loads(row["meta"]) if row["meta"] else None
+        }
+        c.execute(SQL_GET_OPTIONS, (qid,))
+        q["options"] = [{"id": r["id"], "text": r["option_text"]} for r in c.fetchall()]
+        return q
 
+@st.cache_data(ttl=2.0, show_spinner=False)
 def get_all_questions():
-    c.execute("SELECT id, question_text, created_at FROM questions ORDER BY created_at DESC")
-    return c.fetchall()
+    with db().read() as c:
+        c.execute(SQL_GET_ALL_QUESTIONS)
+        # Plain tuples: st.cache_data has to pickle the result and sqlite3.Row can't be
+        return [(r["id"], r["question_text"], r["created_at"]) for r in c.fetchall()]
 
-def record_vote(question_id: int, option_id: int):
-    created_at = datetime.utcnow().isoformat()
-    c.execute("INSERT INTO votes (question_id, option_id, created_at) VALUES (?, ?, ?)",
-              (question_id, option_id, created_at))
-    conn.commit()
+@st.cache_data(ttl=2.0, show_spinner=False)
+def get_question_labels():
+    # {qid: "qid - text"} for selectboxes, newest first
+    return {qid: f"{qid} - {qtext}" for qid, qtext, _ in get_all_questions()}
+
+def record_vote(question_id: int, option_id: int, wait: bool = False) -> bool:
+    # Written by the background VoteWriter within ~200ms, or right away with wait=True.
+    # Returns False only when wait=True and the write failed (the vote stays queued).
+    writer = vote_writer()
+    writer.put(question_id, option_id)
+    return writer.flush() if wait else True
 
+@st.cache_data(ttl=2.0, show_spinner=False)
 def get_results(question_id: int):
-    c.execute("""
-        SELECT o.option_text, COUNT(v.id) AS cnt, o.id
-        FROM options o
-        LEFT JOIN votes v ON v.option_id = o.id AND v.question_id=?
-        WHERE o.question_id=?
-        GROUP BY o.id, o.option_text
-        ORDER BY o.id
-    """, (question_id, question_id))
-    rows = c.fetchall()
-    return [{"option_text": r[0], "count": r[1], "option_id": r[2]} for r in rows]
+    with db().read() as c:
+        c.execute(SQL_GET_RESULTS, (question_id, question_id))
+        return [{"option_text": r["option_text"], "count": r["cnt"], "option_id": r["option_id"],
+                 "percent": r["pct"]} for r in c.fetchall()]
+
+@st.cache_data(ttl=2.0, show_spinner=False)
+def get_all_results():
+    with db().read() as c:
+        c.execute(SQL_GET_ALL_RESULTS)
+        results = {}
+        for r in c.fetchall():
+            results.setdefault(r["question_id"], []).append(
+                {"option_text": r["option_text"], "count": r["cnt"], "option_id": r["option_id"]})
+        return results
 
 def delete_question(question_id: int):
-    c.execute("DELETE FROM votes WHERE question_id=?", (question_id,))
-    c.execute("DELETE FROM options WHERE question_id=?", (question_id,))
-    c.execute("DELETE FROM questions WHERE id=?", (question_id,))
-    conn.commit()
+    with vote_writer().write() as c:
+        c.execute("DELETE FROM votes WHERE question_id=?", (question_id,))
+        c.execute("DELETE FROM options WHERE question_id=?", (question_id,))
+        c.execute("DELETE FROM questions WHERE id=?", (question_id,))
+    invalidate_caches()
+
+def delete_all():
+    with vote_writer().write() as c:
+        c.execute("DELETE FROM votes")
+        c.execute("DELETE FROM options")
+        c.execute("DELETE FROM questions")
+    invalidate_caches()
+
+def invalidate_caches():
+    get_all_questions.clear()
+    get_question_labels.clear()
+    get_results.clear()
+    get_all_results.clear()
+
+# Rendered client-side by Vega-Lite, so the server only ships a small spec
+def results_chart(options: list, percentages: list):
+    import altair as alt  # only needed on the results views
+    pct = np.fromiter(percentages, dtype=np.float64, count=len(percentages))
+    df = pd.DataFrame({
+        "option": options,
+        "pct": pct,
+        "label": np.char.mod("%.1f%%", pct),
+    })
+    base = alt.Chart(df).encode(
+        x=alt.X("option:N", sort=None, title=None),
+        y=alt.Y("pct:Q", title="Percentage", scale=alt.Scale(domain=[0, 100])),
+    )
+    bars = base.mark_bar()
+    labels = base.mark_text(dy=-8).encode(text="label:N")
+    return (bars + labels).properties(width="container", height=300)
 
 # -----------------------
 # Public QR voting mode
@@ -128,11 +370,16 @@ def delete_question(question_id: int):
 query_params = st.query_params
 
 if "q" in query_params:
-    try:
-        question_id = int(query_params["q"])
-    except:
-        st.error("Invalid question id.")
-        st.stop()
+    # Parsed once per ?q= value; reruns (e.g. after voting) reuse it
+    raw_qid = query_params["q"]
+    if st.session_state.get("voting_q") != raw_qid:
+        try:
+            st.session_state["voting_qid"] = int(raw_qid)
+        except ValueError:
+            st.error("Invalid question id.")
+            st.stop()
+        st.session_state["voting_q"] = raw_qid
+    question_id = st.session_state["voting_qid"]
 
     q = get_question(question_id)
     if q is None:
@@ -142,13 +389,15 @@ if "q" in query_params:
     st.title("🗳️ Vote — " + q["question_text"])
     st.write("Select one option and submit your vote.")
 
-    option_ids = [opt["id"] for opt in q["options"]]
-    option_texts = [opt["text"] for opt in q["options"]]
-    selected = st.radio("Choose an option:", option_texts)
-    selected_option_id = option_ids[option_texts.index(selected)]
+    id_to_text = {opt["id"]: opt["text"] for opt in q["options"]}
+    selected_option_id = st.radio("Choose an option:", list(id_to_text),
+                                  format_func=id_to_text.get)
 
     if st.button("Submit Vote"):
-        record_vote(question_id, selected_option_id)
+        # Wait for the write so the results below include this vote
+        if not record_vote(question_id, selected_option_id, wait=True):
+            st.error("Your vote could not be saved right now; it is queued and will be retried.")
+            st.stop()
         st.success("✅ Your vote has been recorded!")
 
         results = get_results(question_id)
@@ -156,14 +405,8 @@ if "q" in query_params:
         if total > 0:
             st.subheader("Live Results")
             options = [r["option_text"] for r in results]
-            counts = [r["count"] for r in results]
-            percentages = [(c / total) * 100 for c in counts]
-            fig, ax = plt.subplots(figsize=(8, 4))
-            bars = ax.bar(options, percentages, width=0.6)
-            ax.set_ylim(0, 100)
-            ax.set_ylabel("Percentage")
-            ax.bar_label(bars, labels=[f"{p:.1f}%" for p in percentages], padding=3)
-            st.pyplot(fig)
+            percentages = [r["percent"] for r in results]
+            st.altair_chart(results_chart(options, percentages))
     st.stop()
 
 # -----------------------
@@ -179,22 +422,24 @@ if menu == "Upload Questions":
     st.header("📤 Upload Questions Excel")
     uploaded_file = st.file_uploader("Upload Excel (.xlsx)", type=["xlsx"])
     if uploaded_file:
-        df = pd.read_excel(uploaded_file)
+        df = load_excel(uploaded_file.getvalue())
         if "Question" not in df.columns:
             st.error("Excel must have a 'Question' column.")
             st.stop()
         st.write(df)
         set_name = st.text_input("Optional: Set name for this upload")
         if st.button("Save Questions"):
-            count = 0
-            for _, row in df.iterrows():
-                qtext = str(row["Question"]).strip()
-                options = [str(v).strip() for v in row[1:].tolist()
-                           if pd.notna(v) and str(v).strip()]
+            batch = []
+            questions = df["Question"].astype("string").str.strip().fillna("").to_numpy()
+            opts = df.iloc[:, 1:].astype("string").apply(lambda col: col.str.strip())
+            opts_matrix = opts.to_numpy(dtype=object)
+            opts_mask = (opts.notna() & (opts != "")).to_numpy(dtype=bool)
+            for qtext, opts_row, keep in zip(questions, opts_matrix, opts_mask):
+                options = opts_row[keep].tolist()
                 if qtext and len(options) >= 2:
-                    insert_question_with_options(qtext, options, {"upload_name": set_name or None})
-                    count += 1
-            st.success(f"✅ Saved {count} question(s).")
+                    batch.append((qtext, options, {"upload_name": set_name or None}))
+            insert_batch(batch)
+            st.success(f"✅ Saved {len(batch)} question(s).")
             st.rerun()
 
 # Questions Manager
@@ -204,15 +449,15 @@ elif menu == "Questions Manager":
     if not rows:
         st.info("No questions found.")
     else:
+        all_results = get_all_results()
         for qid, qtext, created_at in rows:
             with st.expander(f"{qtext} (ID: {qid})"):
-                q = get_question(qid)
-                st.write("Options:", [o["text"] for o in q["options"]])
+                results = all_results.get(qid, [])
+                st.write("Options:", [r["option_text"] for r in results])
                 if BASE_URL.startswith("http"):
                     vote_url = f"{BASE_URL}?q={qid}"
                     st.code(vote_url)
                     st.image(generate_qr_code_bytes(vote_url), width=200)
-                results = get_results(qid)
                 st.write("Votes:", {r["option_text"]: r["count"] for r in results})
                 if st.button("Delete Question", key=f"del{qid}"):
                     delete_question(qid)
@@ -222,17 +467,15 @@ elif menu == "Questions Manager":
 # Voting Page (local)
 elif menu == "Voting Page (local)":
     st.header("🗳️ Vote Locally")
-    rows = get_all_questions()
-    if not rows:
+    labels = get_question_labels()
+    if not labels:
         st.info("No questions available.")
     else:
-        q_map = {f"{qid} - {qtext}": qid for qid, qtext, _ in rows}
-        choice = st.selectbox("Choose Question", list(q_map.keys()))
-        qid = q_map[choice]
+        qid = st.selectbox("Choose Question", list(labels), format_func=labels.get)
         q = get_question(qid)
-        selected = st.radio("Choose an option:", [o["text"] for o in q["options"]])
+        id_to_text = {o["id"]: o["text"] for o in q["options"]}
+        opt_id = st.radio("Choose an option:", list(id_to_text), format_func=id_to_text.get)
         if st.button("Submit Local Vote"):
-            opt_id = q["options"][[o["text"] for o in q["options"]].index(selected)]["id"]
             record_vote(qid, opt_id)
             st.success("Vote recorded.")
             st.rerun()
@@ -240,34 +483,23 @@ elif menu == "Voting Page (local)":
 # Live Results
 elif menu == "Live Results":
     st.header("📈 Live Results")
-    rows = get_all_questions()
-    if not rows:
+    labels = get_question_labels()
+    if not labels:
         st.info("No questions.")
     else:
-        q_map = {f"{qid} - {qtext}": qid for qid, qtext, _ in rows}
-        choice = st.selectbox("Select Question", list(q_map.keys()))
-        qid = q_map[choice]
+        qid = st.selectbox("Select Question", list(labels), format_func=labels.get)
         results = get_results(qid)
         total = sum(r["count"] for r in results)
         if total == 0:
             st.info("No votes yet.")
         else:
             options = [r["option_text"] for r in results]
-            counts = [r["count"] for r in results]
-            percentages = [(c / total) * 100 for c in counts]
-            fig, ax = plt.subplots(figsize=(8, 4))
-            bars = ax.bar(options, percentages, width=0.6)
-            ax.set_ylim(0, 100)
-            ax.set_ylabel("Percentage")
-            ax.bar_label(bars, labels=[f"{p:.1f}%" for p in percentages], padding=3)
-            st.pyplot(fig)
+            percentages = [r["percent"] for r in results]
+            st.altair_chart(results_chart(options, percentages))
 
 # Admin Cleanup
 elif menu == "Admin: Cleanup":
     st.header("⚠️ Admin Cleanup")
     if st.button("Delete All Questions & Votes"):
-        c.execute("DELETE FROM votes")
-        c.execute("DELETE FROM options")
-        c.execute("DELETE FROM questions")
-        conn.commit()
+        delete_all()
         st.success("All data deleted.")